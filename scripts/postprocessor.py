@@ -1,3 +1,15 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
 
@@ -63,6 +75,30 @@ for key, var in rename_tec.items():
     tec_list = tec_list + var
 
 
+def with_grades(sc, tecs):
+    """
+    Extending a list of technologies with their cost grades in the scenario,
+    e.g., "turbine_g1" for "turbine" (see add_sphs_grades in utilities).
+    """
+    tecs = list(tecs)
+    base = set(tecs)
+    return tecs + [
+        x
+        for x in sc.set("technology")
+        if x not in base and re.sub(r"_g\d+$", "", x) in base
+    ]
+
+
+def merge_grades(df, tecs):
+    """
+    Renaming cost grades of technologies in tecs (e.g., "turbine_g1") to the
+    technology itself, so that they are reported together.
+    """
+    base = df["technology"].str.replace(r"_g\d+$", "", regex=True)
+    df["technology"] = base.where(base.isin(list(tecs)), df["technology"])
+    return df
+
+
 # A utility function for fetching data of a parameter or variable
 def read_var(
     sc,
@@ -120,21 +156,19 @@ def read_var(
         value = "value"
     else:
         value = "lvl"
-    # Fetching variable data
+    # Fetching variable data (including cost grades of technologies)
+    tecs = with_grades(sc, tec_list)
     if time:
         if variable in sc.par_list():
-            df = sc.par(
-                variable, {"node_loc": node, "technology": tec_list, "time": time}
-            )
+            df = sc.par(variable, {"node_loc": node, "technology": tecs, "time": time})
         else:
-            df = sc.var(
-                variable, {"node_loc": node, "technology": tec_list, "time": time}
-            )
+            df = sc.var(variable, {"node_loc": node, "technology": tecs, "time": time})
     else:
         if variable in sc.par_list():
-            df = sc.par(variable, {"node_loc": node, "technology": tec_list})
+            df = sc.par(variable, {"node_loc": node, "technology": tecs})
         else:
-            df = sc.var(variable, {"node_loc": node, "technology": tec_list})
+            df = sc.var(variable, {"node_loc": node, "technology": tecs})
+    df = merge_grades(df, tec_list)
 
     # Results for one year
     if year_result:
@@ -166,6 +200,54 @@ def read_var(
     return df
 
 
+def prefetch_map(func, items, prefetch=2):
+    """
+    Applying a (reading) function to items in background threads while the
+    caller processes earlier results.
+
+    At most "prefetch" items are read ahead, so memory stays bounded, and
+    results are yielded in the order of items as soon as each is ready.
+    Plotting and aggregation of yielded results remain in the calling thread,
+    but func is called from several threads at once. The ixmp Platform and its
+    JDBC backend are not documented as thread-safe, so reading scenarios of
+    one Platform in parallel is at the user's risk: use prefetch > 0 only with
+    a backend known to allow concurrent reads, or with independent data such
+    as SharedScenario copies, and keep 0 otherwise.
+
+    Parameters
+    ----------
+    func : callable
+        Function taking one item, e.g., reading data of a scenario or node.
+    items : iterable
+        Items to be processed.
+    prefetch : int, optional
+        Number of items read ahead in parallel. If 0, items are processed
+        sequentially without threads. The default is 2.
+
+    Yields
+    ------
+    item, result
+        Each item and the output of func for that item.
+
+    """
+    if not prefetch:
+        for x in items:
+            yield x, func(x)
+        return
+
+    with ThreadPoolExecutor(max_workers=prefetch) as pool:
+        queue = deque()
+        for x in items:
+            queue.append((x, pool.submit(func, x)))
+            # Backpressure: waiting for the oldest item before reading more
+            if len(queue) > prefetch:
+                x, fut = queue.popleft()
+                yield x, fut.result()
+        while queue:
+            x, fut = queue.popleft()
+            yield x, fut.result()
+
+
 def equal_pump(act, times):
     """
     Equalizing extra act from pump and turbine in one time (balancing services).
@@ -194,7 +276,127 @@ def equal_pump(act, times):
     return act
 
 
-def monthly_plot(sc, path, node="TJK", yr=2050, pumped_hydro=True):
+class RenderCache:
+    """
+    Cache of saved figures and Excel files, keyed by a hash of the plotted
+    data and the plot settings, for skipping rendering of unchanged results.
+
+    Stored files are listed in "manifest.json" in the cache folder. When the
+    total size exceeds max_size, the least recently used entries are removed.
+    The folder can be shared by parallel processes: the manifest is re-read
+    under a lock file before each change and replaced atomically.
+
+    Parameters
+    ----------
+    directory : string or path
+        Folder for storing cached files.
+    max_size : float, optional
+        Maximum size of the cache in MB. The default is 500.
+    timeout : float, optional
+        Seconds after which a lock file is considered stale (e.g., left by a
+        killed process) and removed. The default is 60.
+
+    """
+
+    def __init__(self, directory, max_size=500, timeout=60):
+        self.directory = directory
+        self.max_size = max_size * 1e6
+        self.timeout = timeout
+        self.manifest_file = os.path.join(directory, "manifest.json")
+        self.lock_file = os.path.join(directory, "manifest.lock")
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = self._load()
+
+    def key(self, frames, **params):
+        """Hash of a list of DataFrames and plot parameters."""
+        h = hashlib.sha256()
+        for df in frames:
+            h.update(repr(list(df.columns)).encode())
+            h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+        h.update(repr(sorted(params.items())).encode())
+        return h.hexdigest()
+
+    def get(self, key, files):
+        """Copying cached files to the given paths, False if not cached."""
+        with self._lock():
+            self.manifest = self._load()
+            entry = self.manifest.get(key)
+            if not entry or len(entry["files"]) != len(files):
+                return False
+            stored = [os.path.join(self.directory, x) for x in entry["files"]]
+            if not all(os.path.exists(x) for x in stored):
+                return False
+            # Copying under the lock, so that no other process evicts them
+            for src, dst in zip(stored, files):
+                shutil.copyfile(src, dst)
+            entry["used"] = time.time()
+            self._save()
+        return True
+
+    def put(self, key, files):
+        """Storing copies of rendered files under a key."""
+        stored = []
+        for i, src in enumerate(files):
+            name = "{}_{}{}".format(key, i, os.path.splitext(src)[1])
+            dst = os.path.join(self.directory, name)
+            tmp = "{}.{}.tmp".format(dst, os.getpid())
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dst)
+            stored.append(name)
+        size = sum(os.path.getsize(os.path.join(self.directory, x)) for x in stored)
+
+        with self._lock():
+            self.manifest = self._load()
+            self.manifest[key] = {"files": stored, "size": size, "used": time.time()}
+
+            # Evicting the least recently used entries above the size limit
+            total = sum(x["size"] for x in self.manifest.values())
+            for k in sorted(self.manifest, key=lambda k: self.manifest[k]["used"]):
+                if total <= self.max_size:
+                    break
+                if k == key:
+                    continue
+                for x in self.manifest[k]["files"]:
+                    path = os.path.join(self.directory, x)
+                    if os.path.exists(path):
+                        os.remove(path)
+                total -= self.manifest.pop(k)["size"]
+            self._save()
+
+    @contextmanager
+    def _lock(self):
+        """Exclusive lock of the manifest across processes (lock file)."""
+        while True:
+            try:
+                fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_file) > self.timeout:
+                        os.remove(self.lock_file)
+                except FileNotFoundError:
+                    pass
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            os.remove(self.lock_file)
+
+    def _load(self):
+        if not os.path.exists(self.manifest_file):
+            return {}
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    def _save(self):
+        tmp = "{}.{}.tmp".format(self.manifest_file, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.manifest_file)
+
+
+def monthly_plot(sc, path, node="TJK", yr=2050, pumped_hydro=True, cache=None):
     """
     Generate plots at the sub-annual timeslice level for one year.
 
@@ -209,6 +411,9 @@ def monthly_plot(sc, path, node="TJK", yr=2050, pumped_hydro=True):
         Model year to be processed. The default is 2050.
     pumped_hydro : bool, optional
         If pumpedhydro to be included in the results. The default is True.
+    cache : RenderCache or None, optional
+        If given, plotting is skipped and the saved figure is copied from
+        the cache when the data and settings are unchanged. The default is None.
 
     """
 
@@ -234,47 +439,39 @@ def monthly_plot(sc, path, node="TJK", yr=2050, pumped_hydro=True):
     else:
         tec_li = ["turbine_dam"] + inflow_tecs
 
-    # 1) Plotting activity of different technologies for water
-    act = (
+    # 1) Loading activity of different technologies for water
+    act_w = (
         sc.var(
             "ACT",
-            {"node_loc": node, "technology": tec_li, "year_act": yr, "time": times},
+            {
+                "node_loc": node,
+                "technology": with_grades(sc, tec_li),
+                "year_act": yr,
+                "time": times,
+            },
         )
+        .pipe(merge_grades, tec_li)
         .groupby(["time", "technology"])
         .sum()
         .reset_index()
     )
-
-    fig = plt.figure("water")
-    for tec in tec_li:
-        y = act.loc[act["technology"] == tec, "lvl"]
-        if "pump" in tec:
-            y = -y
-        if not y.empty:
-            plt.step(times, y, label=tec, where="mid")
-
-    # Laying demand on the same plot
     dem = sc.par(
         "demand", {"node": node, "commodity": water_com, "year": yr, "time": times}
     )
-    plt.step(dem["time"], dem["value"], label="demand", where="mid")
-
-    # Adding legend
-    plt.legend(loc="upper right", ncol=2)
-    plt.title("Water demand and activity of storage technologies in {}".format(yr))
 
-    # 2) Plotting for energy
-    # Loading activity from the model
+    # 2) Loading activity for energy from the model
+    tec_e = tec_list + ["pump", "elec_t_d"] + el_exp
     act = (
         sc.var(
             "ACT",
             {
                 "node_loc": node,
-                "technology": tec_list + ["pump", "elec_t_d"] + el_exp,
+                "technology": with_grades(sc, tec_e),
                 "year_act": yr,
                 "time": times,
             },
         )
+        .pipe(merge_grades, tec_e)
         .groupby(["time", "technology"])
         .sum()
         .reset_index()
@@ -284,6 +481,72 @@ def monthly_plot(sc, path, node="TJK", yr=2050, pumped_hydro=True):
     act = act.sort_values(["time"])
     act["lvl"] *= unit_to_TWh
 
+    # 3) Loading electricity trade
+    trade = pd.DataFrame(
+        index=times,
+        columns=pd.MultiIndex.from_product(
+            [[x for x in nodes.keys() if x != "all"], ["Import", "Export"]],
+            names=["Country", "Direction"],
+        ),
+    )
+    for (n, direct) in trade.columns:
+        if direct == "Import":
+            tec_l = ["elec_imp"]
+        else:
+            tec_l = el_exp
+        d = (
+            sc.var(
+                "ACT",
+                {
+                    "node_loc": n,
+                    "technology": tec_l,
+                    "year_act": yr,
+                    "time": times,
+                },
+            )
+            .groupby(["time"])
+            .sum()
+            .reset_index()
+        )
+        d["time"] = [int(x) for x in d["time"]]
+        d = d.sort_values(["time"])
+        d["lvl"] *= unit_to_TWh
+        if direct == "Import":
+            d["lvl"] *= -1
+        trade.loc[:, (n, direct)] = d["lvl"].values
+
+    # Skipping plots if the same results are in the cache
+    fmt = plt.rcParams["savefig.format"]
+    files = ["{}\\{}_monthly_{}.{}".format(path, sc.scenario, yr, fmt)]
+    if cache:
+        key = cache.key(
+            [act_w, dem, act, trade],
+            plot="monthly",
+            node=node,
+            yr=yr,
+            pumped_hydro=pumped_hydro,
+            color_map=color_map,
+        )
+        if cache.get(key, files):
+            return
+
+    # 1) Plotting activity of different technologies for water
+    fig = plt.figure("water")
+    for tec in tec_li:
+        y = act_w.loc[act_w["technology"] == tec, "lvl"]
+        if "pump" in tec:
+            y = -y
+        if not y.empty:
+            plt.step(times, y, label=tec, where="mid")
+
+    # Laying demand on the same plot
+    plt.step(dem["time"], dem["value"], label="demand", where="mid")
+
+    # Adding legend
+    plt.legend(loc="upper right", ncol=2)
+    plt.title("Water demand and activity of storage technologies in {}".format(yr))
+
+    # 2) Plotting for energy
     fig = plt.figure("energy")
     for tec in rename_tec.keys():
         d = act.loc[act["technology"].isin(rename_tec[tec])].copy()
@@ -322,44 +585,14 @@ def monthly_plot(sc, path, node="TJK", yr=2050, pumped_hydro=True):
     plt.title("Electricity demand and supply (TWh) in {} in {}".format(nodes[node], yr))
     plt.xlabel("Month of year")
     # Saving the file
-    fig.savefig(path + "\\" + sc.scenario + "_" + "monthly_" + str(yr))
+    fig.savefig(files[0])
+    if cache:
+        cache.put(key, files)
 
     # 3) A fig for electricity trade
     fig = plt.figure("trade")
-    trade = pd.DataFrame(
-        index=times,
-        columns=pd.MultiIndex.from_product(
-            [[x for x in nodes.keys() if x != "all"], ["Import", "Export"]],
-            names=["Country", "Direction"],
-        ),
-    )
-    for (node, direct) in trade.columns:
-        if direct == "Import":
-            tec_l = ["elec_imp"]
-        else:
-            tec_l = el_exp
-        act = (
-            sc.var(
-                "ACT",
-                {
-                    "node_loc": node,
-                    "technology": tec_l,
-                    "year_act": yr,
-                    "time": times,
-                },
-            )
-            .groupby(["time"])
-            .sum()
-            .reset_index()
-        )
-        act["time"] = [int(x) for x in act["time"]]
-        act = act.sort_values(["time"])
-        act["lvl"] *= unit_to_TWh
-        if direct == "Import":
-            act["lvl"] *= -1
-        trade.loc[:, (node, direct)] = act["lvl"].values
-
-        plt.step(trade.index, act["lvl"].values, label=(node, direct), where="mid")
+    for (n, direct) in trade.columns:
+        plt.step(trade.index, trade[(n, direct)].values, label=(n, direct), where="mid")
 
     # Adding legend
     ax = plt.gca()
@@ -378,7 +611,15 @@ def monthly_plot(sc, path, node="TJK", yr=2050, pumped_hydro=True):
     plt.xlabel("Month of year")
 
 
-def yearly_plot(sc, path, plot_type="activity", region="all", aggregate="all"):
+def yearly_plot(
+    sc,
+    path,
+    plot_type="activity",
+    region="all",
+    aggregate="all",
+    prefetch=0,
+    cache=None,
+):
     """
     Plotting yearly values over multiple decades
 
@@ -393,6 +634,13 @@ def yearly_plot(sc, path, plot_type="activity", region="all", aggregate="all"):
         list of model regions to be visualized
     aggregate: string
         adding the aggregate of all regions
+    prefetch: int (default 0)
+        number of regions read from the database in background while the
+        current one is processed (0 for sequential reading); only for
+        backends that allow concurrent reads, see prefetch_map
+    cache: RenderCache or None (default None)
+        if given, plotting and writing to Excel are skipped and saved files
+        are copied from the cache when the data and settings are unchanged
     """
     # Check if solution exists
     if not sc.has_solution():
@@ -405,15 +653,11 @@ def yearly_plot(sc, path, plot_type="activity", region="all", aggregate="all"):
         ti = "year"
         tit = "Electricity generation mix"
         ylab = "TWh"
-        if path:
-            writer = pd.ExcelWriter(path + "\\activity.xlsx")
     else:
         variable = ["CAP", "capacity"]
         ti = None
         tit = "Total installed capacity"
         ylab = "GW"
-        if path:
-            writer = pd.ExcelWriter(path + "\\capacity.xlsx")
 
     dict_xls = {}
 
@@ -424,6 +668,43 @@ def yearly_plot(sc, path, plot_type="activity", region="all", aggregate="all"):
     if aggregate:
         region = region + [aggregate]
 
+    def _read(node):
+        d = read_var(sc, variable[0], tec_list, ti, node, "year_act", rename_tec)
+        d.index.name = "Year"
+        if plot_type == "activity":
+            d *= unit_to_TWh
+
+        # Making export with negative sign
+        if "export" in d.columns:
+            d["export"] = -d["export"]
+        # Removing import/export from Central Asia as a whole
+        if node == "all":
+            d.loc[:, d.columns.isin(["import", "export"])] = 0
+        return d
+
+    # Loading activity (next regions are read while the current one is plotted)
+    data = prefetch_map(_read, region, prefetch)
+
+    # Skipping plots and xls if the same results are in the cache
+    fmt = plt.rcParams["savefig.format"]
+    files = [
+        "{}\\{}_{}.{}".format(path, sc.scenario, variable[1], fmt),
+        "{}\\{}.xlsx".format(path, variable[1]),
+    ]
+    if cache:
+        # All regions are needed for the key before plotting
+        data = list(data)
+        key = cache.key(
+            [d for _, d in data],
+            plot="yearly",
+            plot_type=plot_type,
+            region=region,
+            aggregate=aggregate,
+            color_map=color_map,
+        )
+        if cache.get(key, files):
+            return
+
     # Subplots
     height = int(len(region)) if len(region) % 2 != 0 else int(len(region) / 2)
     breath = 1 if len(region) % 2 != 0 else 2
@@ -436,21 +717,8 @@ def yearly_plot(sc, path, plot_type="activity", region="all", aggregate="all"):
     else:
         axes = [axes]
     f = 0
-    for ax, node in zip(axes, region):
+    for ax, (node, d) in zip(axes, data):
         f = f + 1
-        # Loading activity
-        d = read_var(sc, variable[0], tec_list, ti, node, "year_act", rename_tec)
-        d.index.name = "Year"
-        if plot_type == "activity":
-            d *= unit_to_TWh
-
-        # Making export with negative sign
-        if "export" in d.columns:
-            d["export"] = -d["export"]
-        # Removing import/export from Central Asia as a whole
-        if node == "all":
-            d.loc[:, d.columns.isin(["import", "export"])] = 0
-
         # For writing to xls
         dict_xls[nodes[node]] = d
 
@@ -489,9 +757,10 @@ def yearly_plot(sc, path, plot_type="activity", region="all", aggregate="all"):
     plt.show()
 
     # Saving the file
-    fig.savefig(path + "\\" + sc.scenario + "_" + variable[1])
+    fig.savefig(files[0])
 
     # Saving xls file
+    writer = pd.ExcelWriter(files[1])
     for sh in dict_xls.keys():
         df = dict_xls[sh]
         vre = [c for c in df.columns if c in ["wind", "solar PV"]]
@@ -505,6 +774,8 @@ def yearly_plot(sc, path, plot_type="activity", region="all", aggregate="all"):
         df.to_excel(writer, sheet_name=sh)
     writer.save()
     writer.close()
+    if cache:
+        cache.put(key, files)
 
 
 def cost_emission_plot(sc, name="Baseline", max_yr=2055):
@@ -628,6 +899,7 @@ def compare_scenarios(
     min_yr=2015,
     max_yr=2055,
     unit_conversion=44 / 12,  # converting MtC to MtCO2
+    prefetch=0,
 ):
     """
     Comparing different scenarios on some output variables (costs, emissions).
@@ -648,6 +920,10 @@ def compare_scenarios(
         Maximum year for visualization.
     unit_conversion : float
         Conversion from model units for CO2 emissions to MtCO2
+    prefetch : int
+        Number of scenarios read from the database in background while the
+        current one is aggregated (0 for sequential reading). Use only with
+        backends that allow concurrent reads, see prefetch_map.
     """
 
     tit = "Total costs and GHG emissions in different scenarios"
@@ -684,9 +960,19 @@ def compare_scenarios(
         f = f + 1
 
         df_tot = pd.DataFrame()
-        for name, scen in scenarios.items():
+
+        def _read(item):
+            scen = item[1]
+            if "COST_NODAL_NET" in varname:
+                return scen.var(varname)
+            elif emission_from_relations:
+                return scen.var("ACT", {"technology": tec_list, "time": "year"})
+            else:
+                return scen.var(varname, {"emission": "TCE", "type_tec": "all"})
+
+        # Next scenarios are read while the current one is aggregated
+        for (name, _), df in prefetch_map(_read, scenarios.items(), prefetch):
             if "COST_NODAL_NET" in varname:
-                df = scen.var(varname)
                 yr_col = "year"
                 node_col = "node"
                 # Sorting and averaging
@@ -699,11 +985,9 @@ def compare_scenarios(
                     df *= 1000
             elif varname == "EMISS":
                 if emission_from_relations:
-                    df = scen.var("ACT", {"technology": tec_list, "time": "year"})
                     yr_col = "year_act"
                     node_col = "node_loc"
                 else:
-                    df = scen.var(varname, {"emission": "TCE", "type_tec": "all"})
                     yr_col = "year"
                     node_col = "node"
 
@@ -767,3 +1051,612 @@ def compare_scenarios(
         leg.set_linewidth(1)
         leg.set_edgecolor("black")
     plt.show()
+
+
+def _dense_array(df, dims, value, labels):
+    """
+    Scattering a long table into a dense numpy array (duplicates are summed).
+
+    Parameters
+    ----------
+    df : DataFrame
+        Long table with one column per dimension and one value column.
+    dims : list
+        Column names forming the axes of the array, in order.
+    value : string
+        Name of the value column, e.g., "lvl" or "value".
+    labels : dict
+        Ordered labels of each dimension, e.g., {"time": ["1", "2", ...]}.
+
+    Returns
+    -------
+    arr : numpy.ndarray
+        Array of shape (len(labels[d]) for d in dims); missing entries are zero.
+
+    """
+    arr = np.zeros([len(labels[d]) for d in dims])
+    codes = [pd.Categorical(df[d], categories=labels[d]).codes for d in dims]
+    # Dropping rows with labels outside the selection
+    keep = np.logical_and.reduce([c >= 0 for c in codes])
+    np.add.at(arr, tuple(c[keep] for c in codes), df[value].values[keep])
+    return arr
+
+
+def vre_analytics(
+    sc,
+    tecs=["wind_ppl", "wind_ppf", "solar_pv_ppl"],
+    node="all",
+    year_min=2020,
+    year_max=2050,
+    aggregate="all",
+):
+    """
+    Realised capacity factors, curtailment and balancing needs of variable
+    renewables per node, technology, timeslice and year.
+
+    CAP, ACT, "capacity_factor" and "duration_time" are scattered into dense
+    arrays of (node, technology, time, year) and all indicators are computed
+    in one vectorized pass:
+    - potential: sum over vintages of CAP x capacity_factor x duration_time
+    - curtailment: potential minus generation (ACT), not below zero
+    - capacity_factor: generation / (CAP x duration_time)
+    - balancing: deviation of generation from a flat profile with the same
+      annual energy (positive: surplus to be stored or exported, negative:
+      deficit to be covered by other sources)
+
+    Parameters
+    ----------
+    sc : message_ix.Scenario
+    tecs : list, optional
+        VRE technologies to be processed.
+        The default is ["wind_ppl", "wind_ppf", "solar_pv_ppl"].
+    node : string, list or "all", optional
+        Node or list of nodes to be processed. The default is "all".
+    year_min : int, optional
+        Minimum year of data. The default is 2020.
+    year_max : int, optional
+        Maximum year of data. The default is 2050.
+    aggregate : string or None, optional
+        Node name for the aggregate of all nodes, None for no aggregate.
+        The default is "all".
+
+    Returns
+    -------
+    df : DataFrame
+        Table with index (node, technology, time, year) and columns
+        "generation", "potential", "curtailment", "capacity_factor",
+        "balancing" in model units (GWa), capacity factor as fraction.
+
+    """
+    # Check if solution exists
+    if not sc.has_solution():
+        print("Notice: the submitted scenario has no solution!!!")
+        return pd.DataFrame()
+
+    # Nodes and time slices
+    if isinstance(node, str) and node == "all":
+        node = [x for x in sc.set("node") if x not in ["World", "CAS"]]
+    elif not pd.api.types.is_list_like(node):
+        node = [node]
+    node = list(node)
+    times = [x for x in sc.set("time") if x != "year"]
+    years = [int(x) for x in sc.set("year") if year_min <= int(x) <= year_max]
+
+    # Loading data from the model
+    flt = {"node_loc": node, "technology": with_grades(sc, tecs)}
+    act = sc.var("ACT", dict(flt, time=times))
+    cap = sc.var("CAP", flt)
+    cf = sc.par("capacity_factor", dict(flt, time=times))
+    dur = sc.par("duration_time", {"time": times}).set_index("time")["value"]
+    dur = dur.reindex(times).fillna(0).values
+
+    # Potential generation per vintage (CAP x capacity factor)
+    idx = ["node_loc", "technology", "year_vtg", "year_act"]
+    pot = cf.merge(cap[idx + ["lvl"]], on=idx, how="inner")
+    pot["lvl"] *= pot["value"]
+    act, cap, pot = [merge_grades(x, tecs) for x in (act, cap, pot)]
+
+    # Dense arrays of (node, technology, time, year)
+    labels = {"node_loc": node, "technology": tecs, "time": times}
+    labels["year_act"] = years
+    dims = ["node_loc", "technology", "time", "year_act"]
+    gen = _dense_array(act, dims, "lvl", labels)
+    pot = _dense_array(pot, dims, "lvl", labels) * dur[None, None, :, None]
+    cap = _dense_array(cap, [d for d in dims if d != "time"], "lvl", labels)
+    cap = cap[:, :, None, :] * dur[None, None, :, None]
+
+    # Aggregate of the region appended as an extra node
+    if aggregate:
+        gen, pot, cap = [
+            np.concatenate([x, x.sum(axis=0, keepdims=True)]) for x in (gen, pot, cap)
+        ]
+        node = node + [aggregate]
+
+    # Indicators
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cf_real = np.where(cap > 0, gen / cap, np.nan)
+        flat = gen.sum(axis=2, keepdims=True) * dur[None, None, :, None] / dur.sum()
+    res = {
+        "generation": gen,
+        "potential": pot,
+        "curtailment": np.clip(pot - gen, 0, None),
+        "capacity_factor": cf_real,
+        "balancing": gen - flat,
+    }
+
+    index = pd.MultiIndex.from_product(
+        [node, tecs, times, years], names=["node", "technology", "time", "year"]
+    )
+    df = pd.DataFrame({k: v.reshape(-1) for k, v in res.items()}, index=index)
+
+    # Removing technologies that are not built
+    built = df.groupby(level=["node", "technology"])["potential"].transform("sum")
+    return df.loc[built > 0]
+
+
+# Shared-memory blocks created by share_scenario() in this (loader) process
+_shm_blocks = {}
+
+
+def _share_frame(df):
+    """
+    Copying a table into one shared-memory block, with index columns stored
+    as int32 categorical codes (-1 for missing values) and float columns as
+    float64.
+
+    Returns the block and a picklable description of its layout.
+    """
+    cols, arrays, offset = {}, [], 0
+    for c in df.columns:
+        if pd.api.types.is_float_dtype(df[c]):
+            arr, cats = df[c].to_numpy(np.float64), None
+        else:
+            cat = pd.Categorical(df[c])
+            arr, cats = cat.codes.astype(np.int32), cat.categories.tolist()
+        cols[c] = (arr.dtype.str, offset, cats)
+        arrays.append(arr)
+        offset += -(-arr.nbytes // 8) * 8  # keeping arrays 8-byte aligned
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (dtype, off, _), arr in zip(cols.values(), arrays):
+        np.ndarray(arr.shape, dtype, shm.buf, off)[:] = arr
+    return shm, {"name": shm.name, "length": len(df), "columns": cols}
+
+
+def _read_shared(meta, filters=None):
+    """
+    Reading a slice of a shared table, filtered on the codes in place.
+    Only the selected rows are copied into the returned DataFrame.
+    """
+    shm = shared_memory.SharedMemory(name=meta["name"])
+    try:
+        views = {
+            c: np.ndarray((meta["length"],), dtype, shm.buf, off)
+            for c, (dtype, off, _) in meta["columns"].items()
+        }
+        mask = np.ones(meta["length"], dtype=bool)
+        for col, val in (filters or {}).items():
+            val = val if pd.api.types.is_list_like(val) else [val]
+            cats = pd.Index(meta["columns"][col][2])
+            codes = cats.get_indexer(pd.Index(list(val)).astype(cats.dtype))
+            mask &= np.isin(views[col], codes[codes >= 0])
+        df = pd.DataFrame(
+            {
+                c: views[c][mask]
+                if cats is None
+                else np.asarray(pd.Categorical.from_codes(views[c][mask], cats))
+                for c, (_, _, cats) in meta["columns"].items()
+            }
+        )
+        del views
+    finally:
+        shm.close()
+    return df
+
+
+def share_scenario(
+    sc,
+    variables=["ACT", "CAP"],
+    parameters=[],
+    sets=["node", "technology", "commodity", "time", "year"],
+):
+    """
+    Publishing results of a scenario in shared memory for worker processes.
+
+    Each variable or parameter is read once and stored as numeric arrays
+    (categorical codes for index columns). Workers open the returned handle
+    with SharedScenario and read their slices without copying or unpickling
+    the whole tables. Call release_scenario(handle) from this process when
+    all workers are done.
+
+    Parameters
+    ----------
+    sc : message_ix.Scenario
+    variables : list, optional
+        Variables to be shared. The default is ["ACT", "CAP"].
+    parameters : list, optional
+        Parameters to be shared, e.g., ["demand"]. The default is [].
+    sets : list, optional
+        Sets to be passed (small, sent with the handle).
+        The default is ["node", "technology", "commodity", "time", "year"].
+
+    Returns
+    -------
+    handle : dict
+        Picklable description of shared data to be sent to workers.
+
+    """
+    handle = {
+        "model": sc.model,
+        "scenario": sc.scenario,
+        "version": sc.version,
+        "has_solution": sc.has_solution(),
+        "sets": {x: sc.set(x).tolist() for x in sets},
+        "par": {},
+        "var": {},
+    }
+    for kind, names, read in [("var", variables, sc.var), ("par", parameters, sc.par)]:
+        for name in names:
+            shm, handle[kind][name] = _share_frame(read(name))
+            _shm_blocks[shm.name] = shm
+    return handle
+
+
+def release_scenario(handle):
+    """
+    Freeing shared memory of a handle created by share_scenario().
+    """
+    for meta in list(handle["var"].values()) + list(handle["par"].values()):
+        shm = _shm_blocks.pop(meta["name"], None)
+        if shm:
+            shm.close()
+            shm.unlink()
+
+
+class SharedScenario:
+    """
+    Read-only view of scenario data published by share_scenario(), to be
+    used in worker processes in place of message_ix.Scenario, e.g.,
+    read_var(SharedScenario(handle), "ACT", tec_list, node="TJK").
+
+    Parameters
+    ----------
+    handle : dict
+        Output of share_scenario() in the loader process.
+
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.model = handle["model"]
+        self.scenario = handle["scenario"]
+        self.version = handle["version"]
+
+    def has_solution(self):
+        return self.handle["has_solution"]
+
+    def par_list(self):
+        return list(self.handle["par"])
+
+    def set(self, name):
+        return pd.Series(self.handle["sets"][name])
+
+    def par(self, name, filters=None):
+        return _read_shared(self.handle["par"][name], filters)
+
+    def var(self, name, filters=None):
+        return _read_shared(self.handle["var"][name], filters)
+
+
+def relation_diagnostics(
+    scenarios,
+    relations,
+    tol=1e-6,
+    duals={
+        "relation_lower_time": "RELATION_CONSTRAINT_LO_TIME",
+        "relation_upper_time": "RELATION_CONSTRAINT_UP_TIME",
+    },
+    prefetch=0,
+):
+    """
+    Realised values of user-defined relations (e.g., "share_renewable" added
+    by add_share_activity) and whether their bounds are binding.
+
+    The left-hand side is calculated for all relations at once as the sum of
+    "relation_activity_time" coefficients x ACT (summed over vintages).
+
+    Parameters
+    ----------
+    scenarios : message_ix.Scenario or dict
+        A solved scenario, or a dictionary with the scenario names as keys
+        and scenario objects as values.
+    relations : list
+        Names of relations to be checked.
+    tol : float, optional
+        Tolerance of slack for a bound to be binding. The default is 1e-6.
+    duals : dict, optional
+        Name of equations for the duals of each bound parameter
+        ("relation_lower_time", "relation_upper_time"). Both bounds are
+        always read; this is only used for looking up duals, which are
+        left empty if the equation does not exist in the scenario.
+    prefetch : int, optional
+        Number of scenarios read from the database in background. Use only
+        with backends that allow concurrent reads, see prefetch_map.
+        The default is 0.
+
+    Returns
+    -------
+    df : DataFrame
+        Table with index (scenario, relation, node, year, time) and columns
+        "lhs", "lower", "upper", "slack_lower", "slack_upper", "binding"
+        ("lower", "upper", or empty), "dual_lower", "dual_upper".
+
+    """
+    if not isinstance(scenarios, dict):
+        scenarios = {scenarios.scenario: scenarios}
+    bound_side = {"relation_lower_time": "lower", "relation_upper_time": "upper"}
+    idx = ["relation", "node_rel", "year_rel", "time"]
+    act_idx = ["node_loc", "technology", "year_act", "mode", "time"]
+
+    def _read(item):
+        scen = item[1]
+        coef = scen.par("relation_activity_time", {"relation": relations})
+        act = scen.var("ACT", {"technology": coef["technology"].unique().tolist()})
+        bounds = {b: scen.par(b, {"relation": relations}) for b in bound_side}
+        equs = scen.equ_list() if hasattr(scen, "equ_list") else []
+        marg = {
+            b: scen.equ(e, {"relation": relations})
+            for b, e in duals.items()
+            if e in equs
+        }
+        return coef, act, bounds, marg
+
+    res = []
+    for (name, scen), (coef, act, bounds, marg) in prefetch_map(
+        _read, scenarios.items(), prefetch
+    ):
+        # Sparse product of coefficients and activity
+        act = act.groupby(act_idx)["lvl"].sum()
+        coef = coef.join(act, on=act_idx)
+        coef["lhs"] = coef["value"] * coef["lvl"].fillna(0)
+        df = coef.groupby(idx)[["lhs"]].sum()
+
+        # Bounds, slack and duals
+        for b, bound in bounds.items():
+            side = bound_side[b]
+            bound = bound.set_index(idx)["value"].astype(float).rename(side)
+            df = df.join(bound, how="outer")
+            if b in marg:
+                m = marg[b].rename(columns={"node": "node_rel", "year": "year_rel"})
+                on = [x for x in idx if x in m.columns]
+                df = df.join(m.groupby(on)["mrg"].sum().rename("dual_" + side), on=on)
+            else:
+                df["dual_" + side] = np.nan
+        df["lhs"] = df["lhs"].fillna(0)
+        df["slack_lower"] = df["lhs"] - df["lower"]
+        df["slack_upper"] = df["upper"] - df["lhs"]
+
+        # Binding status
+        df["binding"] = ""
+        for side in ["lower", "upper"]:
+            lim = tol * df[side].abs().clip(lower=1)
+            df.loc[df["slack_" + side].abs() <= lim, "binding"] = side
+        df["scenario"] = name
+        res.append(df.reset_index())
+
+    df = pd.concat(res, ignore_index=True).rename(
+        columns={"node_rel": "node", "year_rel": "year"}
+    )
+    for c in ["scenario", "relation", "node", "time", "binding"]:
+        df[c] = df[c].astype("category")
+    cols = ["lhs", "lower", "upper", "slack_lower", "slack_upper", "binding"]
+    return df.set_index(["scenario", "relation", "node", "year", "time"])[
+        cols + ["dual_lower", "dual_upper"]
+    ]
+
+
+# Default metrics for comparison_cube()
+cube_metrics = {
+    "generation": {
+        "variable": "ACT",
+        "groups": rename_tec,
+        "filters": {"time": "year"},
+        "scale": unit_to_TWh,
+    },
+    "capacity": {"variable": "CAP", "groups": rename_tec},
+}
+
+
+class ComparisonCube:
+    """
+    Results of many scenarios in one labelled array with dimensions
+    (metric, scenario, node, group, year), created by comparison_cube().
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Array of values with one axis per dimension.
+    labels : dict
+        Ordered labels of each dimension.
+    reference : string
+        Name of the reference scenario for delta() and pct_change().
+
+    """
+
+    dims = ["metric", "scenario", "node", "group", "year"]
+
+    def __init__(self, data, labels, reference):
+        self.data = data
+        self.labels = labels
+        self.reference = reference
+
+    def _ref(self, reference):
+        i = self.labels["scenario"].index(reference)
+        return self.data[:, [i]]
+
+    def delta(self, reference=None):
+        """Difference of all scenarios to the reference scenario."""
+        reference = reference or self.reference
+        data = self.data - self._ref(reference)
+        return ComparisonCube(data, self.labels, reference)
+
+    def pct_change(self, reference=None):
+        """Change (%) of all scenarios relative to the reference scenario."""
+        reference = reference or self.reference
+        ref = self._ref(reference)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            data = np.where(ref != 0, 100 * (self.data - ref) / ref, np.nan)
+        return ComparisonCube(data, self.labels, reference)
+
+    def year_mean(self, weights=None):
+        """
+        Weighted average over years (as one year labelled "mean").
+
+        Parameters
+        ----------
+        weights : dict, array or None, optional
+            Weights of each year. If None, the length of model periods is
+            used (difference to the previous year). The default is None.
+
+        """
+        years = self.labels["year"]
+        if weights is None:
+            first = years[1] - years[0] if len(years) > 1 else 1
+            weights = np.diff(years, prepend=years[0] - first)
+        elif isinstance(weights, dict):
+            weights = [weights.get(y, 0) for y in years]
+        weights = np.asarray(weights, dtype=float)
+        data = (self.data * weights).sum(axis=-1, keepdims=True) / weights.sum()
+        return ComparisonCube(data, dict(self.labels, year=["mean"]), self.reference)
+
+    def to_frame(self):
+        """Table with index (metric, node, group, year) and scenario columns."""
+        index = pd.MultiIndex.from_product(
+            [self.labels[d] for d in self.dims], names=self.dims
+        )
+        s = pd.Series(self.data.reshape(-1), index=index)
+        df = s.unstack("scenario")[self.labels["scenario"]]
+        return df.loc[(df.fillna(0) != 0).any(axis=1)]
+
+
+def comparison_cube(
+    scenarios,
+    metrics=cube_metrics,
+    year_min=2020,
+    year_max=2050,
+    aggregate="all",
+    prefetch=0,
+):
+    """
+    Stacking results of scenarios into one array of
+    (metric, scenario, node, group, year) for vectorized comparison.
+
+    Parameters
+    ----------
+    scenarios : dict
+        A dictionary with the scenario names as keys and scenario objects as
+        values. The first scenario is the reference for comparison.
+    metrics : dict, optional
+        Metric names and their settings: "variable" (variable or parameter),
+        and optionally "groups" (dict of group: list of technologies, if not
+        given all technologies are summed as "total"), "filters",
+        "node_col" (default "node_loc"), "year_col" (default "year_act"),
+        and "scale" (unit conversion). The default is cube_metrics
+        (generation and capacity grouped by rename_tec).
+    year_min : int, optional
+        Minimum year of data. The default is 2020.
+    year_max : int, optional
+        Maximum year of data. The default is 2050.
+    aggregate : string or None, optional
+        Node name for the aggregate of all nodes. The default is "all".
+    prefetch : int, optional
+        Number of scenarios read from the database in background. Use only
+        with backends that allow concurrent reads, see prefetch_map.
+        The default is 0.
+
+    Returns
+    -------
+    ComparisonCube
+
+    Example
+    -------
+    cube = comparison_cube({"Baseline": base, "SPHS": sphs})
+    cube.delta().year_mean().to_frame()
+
+    """
+    reference = list(scenarios)[0]
+    sc_ref = scenarios[reference]
+
+    # Labels of dimensions
+    groups = []
+    for m in metrics.values():
+        groups += [g for g in m.get("groups", {"total": []}) if g not in groups]
+    labels = {
+        "metric": list(metrics),
+        "scenario": list(scenarios),
+        "node": [x for x in sc_ref.set("node") if x not in ["World", "CAS"]],
+        "group": groups,
+        "year": sorted(
+            int(x) for x in sc_ref.set("year") if year_min <= int(x) <= year_max
+        ),
+    }
+    shape = [len(labels[d]) for d in ComparisonCube.dims]
+    data = np.zeros(shape)
+
+    def _read(item):
+        scen = item[1]
+        res = {}
+        for name, m in metrics.items():
+            filters = dict(m.get("filters", {}))
+            if "groups" in m:
+                filters["technology"] = with_grades(scen, sum(m["groups"].values(), []))
+            if m["variable"] in scen.par_list():
+                res[name] = scen.par(m["variable"], filters)
+            else:
+                res[name] = scen.var(m["variable"], filters)
+        return res
+
+    # Next scenarios are read while the current one is stacked
+    for (s, _), res in prefetch_map(_read, scenarios.items(), prefetch):
+        i = labels["scenario"].index(s)
+        for j, (name, m) in enumerate(metrics.items()):
+            df = res[name]
+            value = "value" if "value" in df.columns else "lvl"
+            df = df.rename(
+                columns={
+                    m.get("node_col", "node_loc"): "node",
+                    m.get("year_col", "year_act"): "year",
+                }
+            )
+            if "groups" in m:
+                tec_group = {t: g for g, tecs in m["groups"].items() for t in tecs}
+                df = merge_grades(df, tec_group)
+                df["group"] = df["technology"].map(tec_group)
+            else:
+                df["group"] = "total"
+            dims = ["node", "group", "year"]
+            data[j, i] = _dense_array(df, dims, value, labels) * m.get("scale", 1)
+
+    # Aggregate of the region appended as an extra node
+    if aggregate:
+        data = np.concatenate([data, data.sum(axis=2, keepdims=True)], axis=2)
+        labels["node"] = labels["node"] + [aggregate]
+    return ComparisonCube(data, labels, reference)
+
+
+def iter_comparison_cubes(scenarios, chunk=10, **kwargs):
+    """
+    Comparing a large number of scenarios in chunks to limit memory.
+
+    Each chunk contains the first (reference) scenario and up to chunk other
+    scenarios. Keyword arguments are passed to comparison_cube().
+
+    Yields
+    ------
+    ComparisonCube
+
+    """
+    names = list(scenarios)
+    reference, others = names[0], names[1:]
+    for k in range(0, max(len(others), 1), chunk):
+        sel = [reference] + others[k : k + chunk]
+        yield comparison_cube({x: scenarios[x] for x in sel}, **kwargs)
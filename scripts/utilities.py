@@ -1,5 +1,8 @@
 from itertools import product
 
+import numpy as np
+import pandas as pd
+
 
 def add_share_activity(
     sc,
@@ -75,3 +78,327 @@ def add_share_activity(
         # Bound of relation
         for node, (bound, num) in product(regions, bounds):
             sc.add_par(bound, [relation, node, yr, "year"], num, "-")
+
+
+def sphs_supply_curve(
+    sites,
+    grades=5,
+    columns={"node": "node", "head": "head", "volume": "volume", "cost": "cost"},
+    efficiency_gen=0.9,
+    efficiency_pump=0.9,
+    duration=None,
+):
+    """
+    Clusters seasonal pumped hydro storage (SPHS) sites into cost grades per
+    node, e.g., from the site data of Hunt et al. (2020).
+
+    Sites of each node are sorted by cost and split into grades of equal
+    cumulative capacity. As "turbine", "pump" and "hydro_pump" are water
+    technologies in the model, electrical capacity of a site is converted to
+    water flow (1000 m3/s) with its electricity yield per unit of water,
+    i.e., density x g x head x efficiency.
+
+    Parameters
+    ----------
+    sites : DataFrame or string
+        Table of sites, or path to a csv or Excel file. Needs columns for
+        model node, head (m), volume (million m3), and cost ($/kW); installed
+        capacity (MW) is read from a column "capacity" if it exists.
+    grades : int, optional
+        Number of cost grades per node. The default is 5.
+    columns : dict, optional
+        Mapping of "node", "head", "volume", "cost" to column names of sites.
+    efficiency_gen : float, optional
+        Generating efficiency of the turbine. The default is 0.9.
+    efficiency_pump : float, optional
+        Efficiency of pumping. The default is 0.9.
+    duration : float or None, optional
+        Hours of discharge at full capacity, used only if sites have no
+        "capacity" column. The default is None.
+
+    Returns
+    -------
+    curve : DataFrame
+        Supply curve with columns node, grade, sites, capacity (GW),
+        energy (GWh), flow_turbine and flow_pump (1000 m3/s), volume
+        (million m3), and cost ($/kW, capacity-weighted).
+
+    """
+    if isinstance(sites, str):
+        if sites.endswith(".csv"):
+            sites = pd.read_csv(sites)
+        else:
+            sites = pd.read_excel(sites)
+    df = sites.rename(columns={v: k for k, v in columns.items()})
+
+    # Energy (GWh) = density x g x head x volume x generating efficiency
+    df["energy"] = 1000 * 9.81 * df["head"] * df["volume"] * 1e6 / 3.6e12
+    df["energy"] *= efficiency_gen
+    # Power of 1000 m3/s water flow (GW) = density x g x head x flow
+    power = 1000 * 9.81 * df["head"] * 1000 / 1e9
+    if "capacity" in df.columns:
+        df["capacity"] = df["capacity"] / 1000
+    elif duration:
+        df["capacity"] = df["energy"] / duration
+    else:
+        raise ValueError("Sites need a 'capacity' column or a 'duration' value.")
+    df["flow_turbine"] = df["capacity"] / (power * efficiency_gen)
+    df["flow_pump"] = df["capacity"] * efficiency_pump / power
+
+    # Cost grades by cumulative capacity of the cheapest sites in each node
+    df = df.sort_values(["node", "cost"])
+    share = df.groupby("node")["capacity"].cumsum() / df.groupby("node")[
+        "capacity"
+    ].transform("sum")
+    # Binning on the share at the start of each site, so that the cheapest
+    # site is always in grade 1, and numbering grades without gaps
+    start = share - df["capacity"] / df.groupby("node")["capacity"].transform("sum")
+    df["grade"] = np.floor(start * grades).clip(0, grades - 1) + 1
+    df["grade"] = df.groupby("node")["grade"].rank(method="dense").astype(int)
+    df["weighted"] = df["cost"] * df["capacity"]
+
+    curve = df.groupby(["node", "grade"]).agg(
+        sites=("cost", "size"),
+        capacity=("capacity", "sum"),
+        energy=("energy", "sum"),
+        flow_turbine=("flow_turbine", "sum"),
+        flow_pump=("flow_pump", "sum"),
+        volume=("volume", "sum"),
+        weighted=("weighted", "sum"),
+    )
+    curve["cost"] = curve.pop("weighted") / curve["capacity"]
+    return curve.reset_index()
+
+
+def add_sphs_grades(
+    sc,
+    curve,
+    storage_tec="hydro_pump",
+    turbine="turbine",
+    pump="pump",
+    volume_unit=31536,
+    flow_unit="1000 m3/s",
+    skip=["bound_", "historical_", "ref_", "inv_cost"],
+):
+    """
+    Adds SPHS cost grades to the model as copies of the existing pumped hydro
+    technologies (e.g., "turbine", "pump", and their storage technology).
+
+    For each node and grade of the supply curve, the storage technology and
+    its charging/discharging technologies in "map_tec_storage" are copied with
+    a suffix "_g<grade>" (all parameters except those in skip). All data is
+    added with one add_par call per parameter.
+
+    Capacities of these technologies are water quantities, so the bounds and
+    costs from the curve are set in water units:
+    - bound_total_capacity_up of turbine and pump: turbine and pump flow of
+      the grade (1000 m3/s)
+    - bound_total_capacity_up of storage_tec: reservoir volume of the grade,
+      as a flow lasting one year (million m3 / volume_unit)
+    - inv_cost of turbine: capacity-weighted site cost in USD/kW, the same
+      basis and unit as inv_cost of the template turbine
+
+    Parameters
+    ----------
+    sc : message_ix.Scenario
+        Scenario checked out for editing.
+    curve : DataFrame
+        Output of sphs_supply_curve().
+    storage_tec : string, optional
+        Storage technology of pumped hydro. The default is "hydro_pump".
+    turbine : string, optional
+        Discharging technology, receiving the investment cost of each grade.
+        The default is "turbine".
+    pump : string, optional
+        Charging technology. The default is "pump".
+    volume_unit : float, optional
+        Million m3 in one unit of water volume of the model (1000 m3/s over a
+        year). The default is 31536.
+    flow_unit : string, optional
+        Unit of water flow in the model. The default is "1000 m3/s".
+    skip : list, optional
+        Parameters (or prefixes of them) not copied to the new technologies.
+        The default is ["bound_", "historical_", "ref_", "inv_cost"].
+
+    """
+    nodes = curve["node"].unique().tolist()
+    storage = sc.set("map_tec_storage")
+    storage = storage.loc[storage["storage_tec"] == storage_tec]
+    templates = [storage_tec] + storage["technology"].unique().tolist()
+    missing = [x for x in nodes if x not in set(storage["node"])]
+    if missing:
+        print("Notice: no pumped hydro storage to be copied in nodes", missing)
+
+    # Pairs of template technology and its new name per node and grade
+    pairs = pd.concat(
+        [
+            storage[["node", "technology"]].set_axis(["node", "template"], axis=1),
+            storage[["node", "storage_tec"]].set_axis(["node", "template"], axis=1),
+        ]
+    ).drop_duplicates()
+    grades = curve[["node", "grade"]].merge(pairs, on="node")
+    grades["new"] = grades["template"] + "_g" + grades["grade"].astype(str)
+    sc.add_set("technology", grades["new"].unique().tolist())
+
+    def _copy(df, node_col):
+        """Replicating template rows for the grades of their node."""
+        df = df.merge(
+            grades,
+            left_on=[node_col, "technology"],
+            right_on=["node", "template"],
+        )
+        if "storage_tec" in df.columns:
+            df["storage_tec"] = df["storage_tec"] + "_g" + df["grade"].astype(str)
+        df["technology"] = df["new"]
+        return df
+
+    # Mapping of storage technologies (storage_tec and level_storage are
+    # index sets of map_tec_storage)
+    new_storage = grades.loc[grades["template"] == storage_tec, "new"]
+    sc.add_set("storage_tec", new_storage.unique().tolist())
+    if "level_storage" in sc.set_list():
+        levels = set(storage["level"]) - set(sc.set("level_storage"))
+        if levels:
+            sc.add_set("level_storage", sorted(levels))
+    cols = storage.columns.tolist()
+    sc.add_set("map_tec_storage", _copy(storage, "node")[cols])
+
+    # Copying parameters of template technologies
+    for par in sc.par_list():
+        idx = sc.idx_names(par)
+        if "technology" not in idx or any(par.startswith(x) for x in skip):
+            continue
+        node_col = "node_loc" if "node_loc" in idx else "node"
+        df = sc.par(par, {"technology": templates, node_col: nodes})
+        if df.empty:
+            continue
+        sc.add_par(par, _copy(df, node_col)[df.columns])
+
+    # Investment cost from the supply curve (USD/kW as in the template)
+    df = sc.par("inv_cost", {"technology": turbine, "node_loc": nodes})
+    df = _copy(df, "node_loc").merge(curve, on=["node", "grade"])
+    df["value"] = df["cost"]
+    df["unit"] = "USD/kW"
+    sc.add_par("inv_cost", df[["node_loc", "technology", "year_vtg", "value", "unit"]])
+
+    # Upper bound on total capacity: water flow and reservoir volume
+    years = [int(x) for x in sc.set("year")]
+    bound = grades.merge(curve, on=["node", "grade"])
+    size = {
+        turbine: bound["flow_turbine"],
+        pump: bound["flow_pump"],
+        storage_tec: bound["volume"] / volume_unit,
+    }
+    bound = bound.loc[bound["template"].isin(size)].copy()
+    bound["value"] = np.select(
+        [bound["template"] == x for x in size],
+        [v.loc[bound.index] for v in size.values()],
+    )
+    bound["unit"] = flow_unit
+    bound = bound.merge(pd.DataFrame({"year_act": years}), how="cross")
+    bound = bound.rename(columns={"node": "node_loc", "new": "technology"})
+    sc.add_par(
+        "bound_total_capacity_up",
+        bound[["node_loc", "technology", "year_act", "value", "unit"]],
+    )
+
+
+class ParameterSnapshot:
+    """
+    Read-only, in-memory copy of scenario parameters for fast repeated
+    lookups, e.g., while calibrating cost or water data.
+
+    Parameters are loaded once and each index column gets a hash index of
+    row positions. par() accepts the same filters as message_ix.Scenario.par
+    and returns the same table. The snapshot reloads itself when the scenario
+    changes: its version or last update (e.g., after commit), or any call of
+    check_out, add_par, remove_par or commit on it.
+
+    Parameters
+    ----------
+    sc : message_ix.Scenario
+    parameters : list
+        Names of parameters to be loaded, e.g., ["inv_cost", "var_cost"].
+
+    Example
+    -------
+    snap = ParameterSnapshot(base, ["inv_cost", "var_cost"])
+    snap.par("inv_cost", {"technology": "coal_ppl", "node_loc": "UZB"})
+
+    """
+
+    def __init__(self, sc, parameters):
+        self.sc = sc
+        self.parameters = list(parameters)
+        self.refresh()
+
+        # Marking the snapshot as outdated when the scenario is edited
+        for method in ["check_out", "add_par", "remove_par", "commit"]:
+            setattr(sc, method, self._invalidating(getattr(sc, method)))
+
+    def _invalidating(self, func):
+        def wrapper(*args, **kwargs):
+            self.stale = True
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    def _state(self):
+        """Version and time of last update of the scenario in the database."""
+        last = self.sc.last_update() if hasattr(self.sc, "last_update") else None
+        return self.sc.version, last
+
+    def refresh(self):
+        """Loading parameters and building indexes from the scenario."""
+        self.state = self._state()
+        self.stale = False
+        self.data = {}
+        self.index = {}
+        for par in self.parameters:
+            df = self.sc.par(par)
+            self.data[par] = df
+            self.index[par] = {
+                col: df.groupby(col, sort=False).indices
+                for col in df.columns
+                if col not in ["value", "unit"]
+            }
+
+    def par(self, name, filters=None):
+        """
+        Returns data of a parameter, similar to message_ix.Scenario.par.
+
+        Parameters
+        ----------
+        name : string
+            Name of parameter. Parameters not in the snapshot are read from
+            the scenario.
+        filters : dict, optional
+            Index names and values (one value or a list) to be selected.
+
+        """
+        if self.stale or self._state() != self.state:
+            self.refresh()
+        if name not in self.data:
+            return self.sc.par(name, filters)
+
+        df = self.data[name]
+        if not filters:
+            return df.copy()
+
+        # Row positions matching each filter, intersected over filters
+        rows = None
+        for col, val in filters.items():
+            if col not in self.index[name]:
+                raise KeyError("'{}' is not an index of '{}'".format(col, name))
+            if not pd.api.types.is_list_like(val):
+                val = [val]
+            # Converting values to the type of the column, e.g., "2020" to 2020
+            try:
+                val = pd.Index(list(val)).astype(self.data[name][col].dtype)
+            except (ValueError, TypeError):
+                pass
+            idx = self.index[name][col]
+            pos = [idx[x] for x in val if x in idx]
+            pos = np.unique(np.concatenate(pos)) if pos else np.array([], dtype=int)
+            rows = pos if rows is None else np.intersect1d(rows, pos)
+        return df.iloc[rows].reset_index(drop=True)